@@ -1,4 +1,5 @@
 import numpy as np
+import pytest
 from hypothesis import strategies, given, example, settings
 import wfsim
 
@@ -9,7 +10,7 @@ import wfsim
        strategies.integers(min_value=0, max_value=1_000))
 @example(data_length=101, n_channels=4, noise_data_length=1000)
 def test_noise(data_length, n_channels, noise_data_length):
-    """Testing wfsim.RawData.add_noise"""
+    """Testing wfsim.RawData.noise_offsets and finalize_channels with noise"""
     if data_length <= 0 or noise_data_length <= 0:
         # Double check the input, cannot make np.arrays with negative
         # dimensions
@@ -33,7 +34,225 @@ def test_noise(data_length, n_channels, noise_data_length):
     noise_data = np.random.randint(-10, 10, size=noise_data_length).astype(np.float)
 
     RawData = wfsim.RawData
-    noise_function = RawData.add_noise
+    id_ts = RawData.noise_offsets(channel_mask, noise_data_length)
 
     # Actually test that we can run the function
-    noise_function(data, channel_mask, noise_data, noise_data_length)
+    RawData.finalize_channels(data, channel_mask, noise_data, noise_data_length, 16000, True, id_ts)
+
+
+def test_finalize_channels():
+    """Testing wfsim.RawData.finalize_channels noise, baseline and saturation in one pass"""
+    rng = np.random.RandomState(15)
+    data = rng.randint(-20000, 0, size=(4, 300))
+    channel_mask = np.array([(True, 0, 299), (False, 0, 0), (True, 50, 120), (True, 280, 299)],
+                            dtype=[('mask', '?'), ('left', '<i8'), ('right', '<i8')])
+    noise_data = rng.randint(-10, 10, size=1000).astype(np.float64)
+    RawData = wfsim.RawData
+
+    np.random.seed(15)
+    id_ts = RawData.noise_offsets(channel_mask, len(noise_data))
+    assert id_ts[1] == 0
+    assert np.all(id_ts + channel_mask['right'] - channel_mask['left'] < len(noise_data))
+
+    for enable_noise in (True, False):
+        expected, result = data.copy(), data.copy()
+        for ch in np.where(channel_mask['mask'])[0]:
+            for ix in range(channel_mask['left'][ch], channel_mask['right'][ch] + 1):
+                # Samples past the end of the noise data get no noise
+                if enable_noise and id_ts[ch] + ix < len(noise_data):
+                    expected[ch, ix] += int(noise_data[id_ts[ch] + ix])
+                expected[ch, ix] = max(expected[ch, ix] + 16000, 0)
+
+        RawData.finalize_channels(result, channel_mask, noise_data, len(noise_data), 16000, enable_noise, id_ts)
+        np.testing.assert_array_equal(result, expected)
+
+
+def test_zle_intervals():
+    """Testing wfsim.utils.zle_intervals against find_intervals_below_threshold per channel"""
+    rng = np.random.RandomState(4)
+    data = np.where(rng.random_sample((5, 500)) < 0.02, 0, 100).astype(np.int32)
+    channel_mask = np.array([(True, 0, 499), (False, 0, 499), (True, 13, 301), (True, 0, 0), (True, 101, 499)],
+                            dtype=[('mask', '?'), ('left', '<i8'), ('right', '<i8')])
+    thresholds = np.array([50, 50, 50, 50, 200])
+    trigger_window = 3
+
+    expected = []
+    result_buffer = np.zeros((1000, 2), dtype=np.int64)
+    for ch in np.where(channel_mask['mask'])[0]:
+        w = data[ch, channel_mask['left'][ch]:channel_mask['right'][ch] + 1]
+        n = wfsim.utils.find_intervals_below_threshold(w, thresholds[ch], 2 * trigger_window + 1, result_buffer)
+        itvs = np.clip(result_buffer[:n] + [-trigger_window, trigger_window], 0, len(w) - 1)
+        expected += [(ch, np.ceil(l / 2) * 2, np.floor(r / 2) * 2) for l, r in itvs]
+
+    result = wfsim.utils.zle_intervals(data, channel_mask, thresholds, 2 * trigger_window + 1, trigger_window)
+    np.testing.assert_array_equal(result, np.array(expected, dtype=np.int64).reshape(-1, 3))
+
+
+def test_fill_s1_timings():
+    """Testing wfsim.S1._fill_s1_timings photon order and decay delays"""
+    t = np.array([0., 1000., 5000.])
+    n_photons = np.array([3, 0, 100_000])
+    recoil_codes = np.array([0, 1, 1])
+    singlet_fractions = np.array([1., 1., 0., 0.])
+    out = np.full(n_photons.sum(), np.nan)
+    # ER photons are all primary singlets with zero lifetime, NR photons are triplets
+    wfsim.S1._fill_s1_timings(t, n_photons, recoil_codes, singlet_fractions, 0., 20.,
+                              1., 1., 10., out)
+    np.testing.assert_array_equal(out[:3], 0.)
+    nr = out[3:]
+    assert np.all(nr >= 5000.)
+    assert abs(np.mean(nr - 5000.) - 20.) < 1.
+
+    out = np.zeros(0)
+    wfsim.S1._fill_s1_timings(t[:0], n_photons[:0], recoil_codes[:0], singlet_fractions, 0., 20.,
+                              1., 1., 10., out)
+
+
+def test_s1_photon_timings_simple():
+    """Testing wfsim.S1.photon_timings with the simple S1 model per instruction"""
+    config = dict(s1_model_type='simple', s1_decay_time=1000., s1_decay_spread=1.)
+    timings = wfsim.S1.photon_timings(np.array([0., 5000.]), np.array([50_000, 10]), np.array([7, 0]),
+                                      config, 'liquid')
+    assert len(timings) == 50_010
+    assert abs(np.mean(timings[:-10]) - 1000.) < 20.
+    assert np.all(timings[-10:] > 4990.)
+
+    with pytest.raises(AttributeError):
+        wfsim.S1.photon_timings(np.array([0., 0.]), np.array([1, 1]), np.array([7, 20]), config, 'liquid')
+
+
+def _pulse(p_double_pe_emision):
+    pulse = wfsim.Pulse.__new__(wfsim.Pulse)
+    pulse.config = dict(detector='XENON1T', gains=np.array([2e6, 0, 2e6, 1e6, 0]),
+                        turned_off_pmts=np.array([1, 4]), channels_bottom=np.array([3, 4]),
+                        p_double_pe_emision=p_double_pe_emision,
+                        pmt_transit_time_mean=0, pmt_transit_time_spread=0,
+                        samples_to_store_before=2, samples_to_store_after=2, sample_duration=10,
+                        pe_pulse_ts=np.arange(-20, 200, 1.), pe_pulse_ys=np.exp(-np.abs(np.arange(-20, 200, 1.)) / 10))
+    pulse.init_channel_masks()
+    pulse.init_pmt_current_templates()
+    # Every pe has exactly the gain of its channel
+    pulse._Pulse__uniform_to_pe_arr = np.ones((5, 2001), dtype=np.float32)
+    pulse.clear_pulse_cache()
+    return pulse
+
+
+def test_pulse_double_pe():
+    """Testing photons and double pe emission per channel of wfsim.Pulse, and their truth"""
+    np.random.seed(0)
+    n_photons = np.array([100, 50, 200, 150, 80])
+    truth_dtype = [('fill', bool), ('type', np.int8), ('time', np.int64), ('endtime', np.float64)] + [
+        (f'{field}_{quantum}', np.float64) for quantum in ('photon', 'electron')
+        for field in ('n', 't_first', 't_last', 't_mean', 't_sigma')] + [('n_photon_bottom', np.float64)]
+
+    for p_double_pe_emision in (0, 0.3, 1):
+        pulse = _pulse(p_double_pe_emision)
+        pulse._photon_channels = np.random.permutation(np.repeat(np.arange(5), n_photons))
+        pulse._photon_timings = np.random.uniform(0, 1000, n_photons.sum())
+        pulse()
+
+        # Turned off channels get no pulse, the others one pulse holding all their photons
+        np.testing.assert_array_equal(pulse._pulses['channel'], [0, 2, 3])
+        np.testing.assert_array_equal(pulse._pulses['photons'], n_photons[[0, 2, 3]])
+
+        # A pulse integrates to its number of pe times the gain per sample duration
+        offsets = np.concatenate(([0], np.cumsum(pulse._pulses['duration'])))
+        charge = np.add.reduceat(pulse._pulses['current'].astype(np.float64), offsets[:-1])
+        n_pe = np.round(charge * 10 / pulse.config['gains'][[0, 2, 3]])
+        n_double_pe = n_pe - n_photons[[0, 2, 3]]
+        if p_double_pe_emision in (0, 1):
+            np.testing.assert_array_equal(n_double_pe, n_photons[[0, 2, 3]] * p_double_pe_emision)
+        assert pulse._n_double_pe == n_double_pe.sum()
+        assert pulse._n_double_pe_bot == n_double_pe[2]
+
+        # Double pe add to the photons in the truth, only the bottom ones to the bottom photons
+        raw_data = wfsim.RawData.__new__(wfsim.RawData)
+        raw_data.config = pulse.config
+        raw_data.pulses = dict(s1=pulse)
+        truth_buffer = np.zeros(1, dtype=truth_dtype)
+        raw_data.get_truth(np.ones(1, dtype=[('type', np.int8), ('time', np.int64)]), truth_buffer)
+        assert truth_buffer['n_photon'][0] == n_photons.sum() + n_double_pe.sum()
+        assert truth_buffer['n_photon_bottom'][0] == n_photons[3:].sum() + n_double_pe[2]
+
+
+class _PatternMap:
+    def __init__(self, patterns):
+        self.patterns = patterns
+
+    def __call__(self, positions):
+        return self.patterns
+
+
+def test_s2_photon_channels():
+    """Testing wfsim.S2.photon_channels with deterministic and empty patterns"""
+    s2 = wfsim.S2.__new__(wfsim.S2)
+    s2.config = dict(s2_mean_area_fraction_top=0, n_tpc_pmts=5, n_top_pmts=2,
+                     channels_bottom=np.arange(2, 5))
+    s2.resource = type('Resource', (), {})()
+    s2.resource.s2_pattern_map = _PatternMap(np.array([[0, 0, 0, 1., 0],
+                                                       [0, 0, 0, 0, 0],
+                                                       [0.5, 0, 0, 0, 0.5],
+                                                       [0, 3., 0, 0, 0]]))
+    n = [4, 2, 10_000, 3]
+    s2._instruction = np.repeat(np.arange(4), n)
+    s2._photon_timings = np.arange(sum(n), dtype=float)
+    s2.photon_channels(np.array(n), np.zeros(4), np.zeros((4, 2)))
+
+    # Photons of an instruction with an empty pattern are removed
+    keep = s2._instruction != 1
+    np.testing.assert_array_equal(s2._photon_timings, np.arange(sum(n))[keep])
+    channels = s2._photon_channels
+    np.testing.assert_array_equal(channels[:4], 3)
+    np.testing.assert_array_equal(channels[-3:], 1)
+    assert set(channels[4:-3]) == {0, 4}
+    assert abs(np.mean(channels[4:-3] == 0) - 0.5) < 0.05
+
+    s2._photon_timings = np.zeros(0)
+    s2.photon_channels(np.zeros(0), np.zeros(0), np.zeros((0, 2)))
+    assert len(s2._photon_channels) == 0
+
+
+def test_add_current_fft():
+    """Testing wfsim.Pulse.add_current_fft against adding templates per photon"""
+    rng = np.random.RandomState(2)
+    dt, template_length, n_samples = 10, 24, 300
+    templates = rng.uniform(0, 1, (dt, template_length)).astype(np.float32)
+    pulse_left = 7
+    photon_timings = rng.randint(pulse_left * dt, (pulse_left + n_samples - template_length) * dt,
+                                 500).astype(np.int32)
+    photon_gains = rng.uniform(0.5, 2, len(photon_timings))
+
+    expected = np.zeros(n_samples)
+    for t, g in zip(photon_timings, photon_gains):
+        start = t // dt - pulse_left
+        expected[start:start + template_length] += templates[t % dt] * g
+
+    for add_current in (wfsim.Pulse.add_current, wfsim.Pulse.add_current_fft):
+        pulse_current = np.zeros(n_samples)
+        add_current(photon_timings, photon_gains, pulse_left, dt, templates, pulse_current)
+        np.testing.assert_allclose(pulse_current, expected, rtol=1e-5, atol=1e-5)
+
+        pulse_current = np.zeros(n_samples)
+        add_current(photon_timings[:0], photon_gains[:0], pulse_left, dt, templates, pulse_current)
+        assert not np.any(pulse_current)
+
+
+def test_inverse_cdf_table():
+    """Testing the wfsim.PMT_Afterpulse inverse cdf tables on cdfs with flat head and tail"""
+    # Channel 0 is flat at zero for 10 bins, rises to 0.5 up to bin 110 and stays flat after,
+    # channel 1 never fires
+    row = np.concatenate([np.zeros(10), np.linspace(0, 0.5, 101), np.full(20, 0.5)])
+    cdf = np.stack([row, np.zeros_like(row)]).astype(np.float32)
+    table = wfsim.PMT_Afterpulse.inverse_cdf_table(cdf, 1001)
+    assert table.shape == (2, 1001)
+    u_grid = np.linspace(0, 1, 1001) * cdf[0, -1]
+    np.testing.assert_array_equal(table[0], [np.argmax(cdf[0].astype(np.float64) >= u) for u in u_grid])
+    assert table[0, 1] == 11
+    assert table[0, -1] == 110
+    assert not np.any(table[1])
+
+    u = np.array([0, 0.25, 0.5, 0.9])
+    delay = wfsim.PMT_Afterpulse.inverse_cdf_lookup(table, np.zeros(len(u), dtype=int), u,
+                                                     cdf[[0] * len(u), -1])
+    # u at and beyond the maximum of the cdf gives the first bin at the maximum
+    np.testing.assert_array_equal(delay, [0, 60, 110, 110])
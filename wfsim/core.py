@@ -1,14 +1,16 @@
 import logging
 
-from numba import njit
+from numba import njit, prange
 import numpy as np
 from scipy.interpolate import interp1d
+from scipy.signal import fftconvolve
+from scipy.special import ndtr, ndtri
 from tqdm import tqdm
 
 from .load_resource import load_config
 from strax import exporter
 from . import units
-from .utils import find_intervals_below_threshold
+from .utils import zle_intervals
 
 export, __all__ = exporter()
 __all__.append('PULSE_TYPE_NAMES')
@@ -17,6 +19,30 @@ log = logging.getLogger('SimulationCore')
 
 PULSE_TYPE_NAMES = ('RESERVED', 's1', 's2', 'unknown', 'pi_el', 'pmt_ap', 'pe_el')
 
+# Tables shared by all Pulse instances built from the same settings, see
+# Pulse.init_pmt_current_templates and Pulse.init_spe_scaling_factor_distributions
+_cached_pmt_current_templates = dict()
+_cached_uniform_to_pe_arr = dict()
+
+
+def _concatenate_pulses(pulses_list):
+    """
+    Merge pulses in structure of arrays layout (see Pulse.__call__) into one such dict.
+    The currents of all pulses are stored back to back, pulse i spans
+    current[offsets[i]:offsets[i + 1]] with offsets the cumsum of duration
+    """
+    pulses = dict(
+        photons=np.zeros(0, dtype=np.int64),
+        channel=np.zeros(0, dtype=np.int64),
+        left=np.zeros(0, dtype=np.int64),
+        right=np.zeros(0, dtype=np.int64),
+        duration=np.zeros(0, dtype=np.int64),
+        current=np.zeros(0, dtype=np.float32))
+    if len(pulses_list):
+        pulses = {k: np.concatenate([p[k] for p in pulses_list]).astype(v.dtype, copy=False)
+                  for k, v in pulses.items()}
+    return pulses
+
 
 @export
 class NestId():
@@ -39,6 +65,7 @@ class Pulse(object):
         self.init_pmt_current_templates()
         self.init_spe_scaling_factor_distributions()
         self.config['turned_off_pmts'] = np.arange(len(config['gains']))[np.array(config['gains']) == 0]
+        self.init_channel_masks()
         
         self.clear_pulse_cache()
 
@@ -64,43 +91,52 @@ class Pulse(object):
         dt = self.config.get('sample_duration', 10) # Getting dt from the lib just once
         self._n_double_pe = self._n_double_pe_bot = 0 # For truth aft output
 
-        counts_start = 0 # Secondary loop index for assigning channel
-        for channel, counts in zip(*np.unique(self._photon_channels, return_counts=True)):
-
-            # Use 'counts' amount of photon for this channel
-            _channel_photon_timings = self._photon_timings[counts_start:counts_start+counts]
-            counts_start += counts
-            if channel in self.config['turned_off_pmts']: continue
+        if len(self._photon_channels) == 0:
+            return
 
+        # Group photons by channel once, then walk over the channel boundaries
+        order = np.argsort(self._photon_channels, kind='stable')
+        _photon_channels = np.asarray(self._photon_channels)[order]
+        _photon_timings = np.asarray(self._photon_timings)[order]
+        n_photons = len(_photon_channels)
+        bounds = np.concatenate(([0],
+                                 np.nonzero(np.diff(_photon_channels))[0] + 1,
+                                 [n_photons]))
+
+        if '_photon_gains' in self.__dict__:
+            # Pmt afterpulses should have gain determined before this step
+            _photon_gains = np.asarray(self._photon_gains)[order]
+        else:
             # If gain of each photon is not specifically assigned
             # Sample from spe scaling factor distribution and to individual gain
-            # In contrast to pmt afterpulse that should have gain determined before this step
-            if '_photon_gains' not in self.__dict__:
-                if self.config['detector'] == 'XENON1T':
-                    _channel_photon_gains = self.config['gains'][channel] \
-                    * self.uniform_to_pe_arr(np.random.random(len(_channel_photon_timings)), channel)
-
-                else:
-                    _channel_photon_gains = self.config['gains'][channel] \
-                    * self.uniform_to_pe_arr(np.random.random(len(_channel_photon_timings)))
-
-                # Add some double photoelectron emission by adding another sampled gain
-                n_double_pe = np.random.binomial(len(_channel_photon_timings),
-                                                 p=self.config['p_double_pe_emision'])
-                self._n_double_pe += n_double_pe
-                if channel in self.config['channels_bottom']:
-                    self._n_double_pe_bot += n_double_pe
-
-                #_dpe_index = np.random.randint(len(_channel_photon_timings),
-                #                               size=n_double_pe)
-                if self.config['detector'] == 'XENON1T':
-                    _channel_photon_gains[:n_double_pe] += self.config['gains'][channel] \
-                    * self.uniform_to_pe_arr(np.random.random(n_double_pe), channel)
-                else:
-                    _channel_photon_gains[:n_double_pe] += self.config['gains'][channel] \
-                    * self.uniform_to_pe_arr(np.random.random(n_double_pe))
-            else:
-                _channel_photon_gains = np.array(self._photon_gains[self._photon_channels == channel])
+            # This is done for all photons at once rather than per channel
+            gains = np.asarray(self.config['gains'])
+            _photon_gains = gains[_photon_channels] \
+                * self.uniform_to_pe_arr_vec(np.random.random(n_photons), _photon_channels)
+
+            # Add some double photoelectron emission by adding another sampled gain
+            dpe_mask = np.random.random(n_photons) < self.config['p_double_pe_emision']
+            dpe_channels = _photon_channels[dpe_mask]
+            _photon_gains[dpe_mask] += gains[dpe_channels] \
+                * self.uniform_to_pe_arr_vec(np.random.random(len(dpe_channels)), dpe_channels)
+
+            dpe_channels = dpe_channels[~self._is_turned_off[dpe_channels]]
+            self._n_double_pe = len(dpe_channels)
+            self._n_double_pe_bot = np.sum(self._is_bottom[dpe_channels])
+
+        # Cast timings to integers once, relative to a multiple of dt so the reminders are kept
+        # and int32 is enough unless the photons span more than ~2 s
+        time_offset = int(np.min(_photon_timings) // dt) * dt
+        _photon_timings_int = np.floor(_photon_timings - time_offset)
+        int_type = np.int32 if _photon_timings_int.max() < np.iinfo(np.int32).max else np.int64
+        _photon_timings_int = _photon_timings_int.astype(int_type)
+
+        pulses = dict(photons=[], channel=[], left=[], right=[], duration=[], current=[])
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            channel = _photon_channels[start]
+            if self._is_turned_off[channel]: continue
+            _channel_photon_timings = _photon_timings[start:end]
+            _channel_photon_gains = _photon_gains[start:end]
 
             # Build a simulated waveform, length depends on min and max of photon timings
             min_timing, max_timing = np.min(
@@ -111,25 +147,51 @@ class Pulse(object):
             pulse_right = (int(max_timing // dt) 
                            + int(self.config['samples_to_store_after'])
                            + self.config.get('samples_after_pulse_center', 20))
-            pulse_current = np.zeros(pulse_right - pulse_left + 1)
+            pulse_current = np.zeros(pulse_right - pulse_left + 1, dtype=np.float32)
+
+            # Convolving with fft pays off for many photons in a short window
+            n_samples, template_length = len(pulse_current), self._template_length
+            if (self.config.get('use_fft_add_current', False) and
+                    len(_channel_photon_timings) * template_length
+                    > 5 * (n_samples + template_length) * np.log(n_samples + template_length)):
+                add_current = Pulse.add_current_fft
+            else:
+                add_current = Pulse.add_current
+
+            add_current(_photon_timings_int[start:end],
+                        _channel_photon_gains,
+                        pulse_left - time_offset // dt,
+                        dt,
+                        self._pmt_current_templates,
+                        pulse_current)
 
-            Pulse.add_current(_channel_photon_timings.astype(int),
-                              _channel_photon_gains,
-                              pulse_left,
-                              dt,
-                              self._pmt_current_templates,
-                              pulse_current)
+            pulses['photons'].append(len(_channel_photon_timings))
+            pulses['channel'].append(channel)
+            pulses['left'].append(pulse_left)
+            pulses['right'].append(pulse_right)
+            pulses['duration'].append(pulse_right - pulse_left + 1)
+            pulses['current'].append(pulse_current)
 
-            # For single event, data of pulse level is small enough to store in dataframe
-            self._pulses.append(dict(
-                photons  = len(_channel_photon_timings),
-                channel  = channel,
-                left     = pulse_left,
-                right    = pulse_right,
-                duration = pulse_right - pulse_left + 1,
-                current  = pulse_current,))
+        # Store pulses as a dict of arrays, with the currents of all pulses back to back
+        pulses['current'] = np.concatenate(pulses['current']) if pulses['current'] else []
+        self._pulses = _concatenate_pulses([pulses])
+        self.max_right = max(pulses['right'], default=-np.inf)
 
 
+    def init_channel_masks(self):
+        """
+        Boolean lookup tables indexed by channel, so membership checks in the
+        photon loops are a single gather instead of a scan over the channel lists
+        """
+        turned_off = np.asarray(self.config['turned_off_pmts'], dtype=int)
+        bottom = np.asarray(self.config['channels_bottom'], dtype=int)
+        n_channels = max([len(self.config['gains'])] + [np.max(c) + 1 for c in (turned_off, bottom) if len(c)])
+
+        self._is_turned_off = np.zeros(n_channels, dtype=bool)
+        self._is_turned_off[turned_off] = True
+        self._is_bottom = np.zeros(n_channels, dtype=bool)
+        self._is_bottom[bottom] = True
+
     def init_pmt_current_templates(self):
         """
         Create spe templates, for 10ns sample duration and 1ns rounding we have:
@@ -137,12 +199,6 @@ class Pulse(object):
         (i, m are integers)
         """
 
-        # Interpolate on cdf ensures that each spe pulse would sum up to 1 pe*sample duration^-1
-        pe_pulse_function = interp1d(
-            self.config.get('pe_pulse_ts'),
-            np.cumsum(self.config.get('pe_pulse_ys')),
-            bounds_error=False, fill_value=(0, 1))
-
         # Samples are always multiples of sample_duration
         sample_duration = self.config.get('sample_duration', 10)
         samples_before = self.config.get('samples_before_pulse_center', 2)
@@ -152,6 +208,20 @@ class Pulse(object):
         # Let's fix this, so everything can be turned into int
         assert pmt_pulse_time_rounding == 1
 
+        # Templates only depend on these settings, reuse them across instances
+        key = (tuple(np.asarray(self.config.get('pe_pulse_ts'), dtype=float).tolist()),
+               tuple(np.asarray(self.config.get('pe_pulse_ys'), dtype=float).tolist()),
+               sample_duration, samples_before, samples_after, pmt_pulse_time_rounding)
+        if key in _cached_pmt_current_templates:
+            self._template_length, self._pmt_current_templates = _cached_pmt_current_templates[key]
+            return
+
+        # Interpolate on cdf ensures that each spe pulse would sum up to 1 pe*sample duration^-1
+        pe_pulse_function = interp1d(
+            self.config.get('pe_pulse_ts'),
+            np.cumsum(self.config.get('pe_pulse_ys')),
+            bounds_error=False, fill_value=(0, 1))
+
         samples = np.linspace(-samples_before * sample_duration,
                               + samples_after * sample_duration,
                               1 + samples_before + samples_after)
@@ -163,12 +233,20 @@ class Pulse(object):
             # Normalize here to counter tiny rounding error from interpolation
             pmt_current *= (1 / sample_duration) / np.sum(pmt_current)  # pe / 10 ns
             templates.append(pmt_current)
-        self._pmt_current_templates = np.array(templates)
+        # Normalized in float64 above, float32 is plenty for the templates themselves
+        self._pmt_current_templates = np.ascontiguousarray(templates, dtype=np.float32)
+        _cached_pmt_current_templates[key] = (self._template_length, self._pmt_current_templates)
 
         log.debug('Create spe waveform templates with %s ns resolution' % pmt_pulse_time_rounding)
 
 
     def init_spe_scaling_factor_distributions(self):
+        # Resources are cached per config by load_config, so they identify the spe distributions
+        key = id(self.resource)
+        if key in _cached_uniform_to_pe_arr:
+            self.__uniform_to_pe_arr = _cached_uniform_to_pe_arr[key]
+            return
+
         # Extract the spe pdf from a csv file into a pandas dataframe
         spe_shapes = self.resource.photon_area_distribution
 
@@ -193,18 +271,32 @@ class Pulse(object):
             uniform_to_pe_arr.append(grid_scale)
 
         if len(uniform_to_pe_arr):
-            self.__uniform_to_pe_arr = np.stack(uniform_to_pe_arr)
+            # Scaling factors are O(1), float32 is plenty and halves the lookup table
+            self.__uniform_to_pe_arr = np.stack(uniform_to_pe_arr).astype(np.float32)
+            _cached_uniform_to_pe_arr[key] = self.__uniform_to_pe_arr
 
         log.debug('Initialize spe scaling factor distributions')
 
 
     def uniform_to_pe_arr(self, p, channel=0):
-        indices = (p * 2000).astype(int)
-        return self.__uniform_to_pe_arr[channel, indices]
+        return self.__uniform_to_pe_arr[channel, (p * 2000).astype(np.uint16)]
+
+    def uniform_to_pe_arr_vec(self, p, channels):
+        """
+        Convert uniform random numbers to spe scaling factors in a single gather
+        p        - dim-1 float array of uniform random numbers
+        channels - dim-1 int array of channel per random number
+        """
+        indices = (p * 2000).astype(np.uint16)  # 2001 grid points fit in uint16
+        if self.config['detector'] != 'XENON1T':
+            # XENONnT uses the same spe distribution for all channels
+            return self.__uniform_to_pe_arr[0, indices]
+        return self.__uniform_to_pe_arr[channels, indices]
 
 
     def clear_pulse_cache(self):
-        self._pulses = []
+        self._pulses = _concatenate_pulses([])
+        self.max_right = -np.inf  # Right of the last pulse, in samples
 
     @staticmethod
     @njit
@@ -227,28 +319,36 @@ class Pulse(object):
             return
         
         template_length = len(pmt_current_templates[0])
-        i_photons = np.argsort(photon_timings)
+        # Template addition is associative, photons do not need to be sorted
         # Convert photon_timings to int outside this function
-        # photon_timings = photon_timings // 1
-
-        gain_total = 0
-        tmp_photon_timing = photon_timings[i_photons[0]]
-        for i in i_photons:
-            if photon_timings[i] > tmp_photon_timing:
-                start = int(tmp_photon_timing // dt) - pulse_left
-                reminder = int(tmp_photon_timing % dt)
-                pulse_current[start:start + template_length] += \
-                    pmt_current_templates[reminder] * gain_total
-
-                gain_total = photon_gains[i]
-                tmp_photon_timing = photon_timings[i]
-            else:
-                gain_total += photon_gains[i]
-        else:
-            start = int(tmp_photon_timing // dt) - pulse_left
-            reminder = int(tmp_photon_timing % dt)
-            pulse_current[start:start + template_length] += \
-                pmt_current_templates[reminder] * gain_total
+        for i in range(len(photon_timings)):
+            start = photon_timings[i] // dt - pulse_left
+            reminder = photon_timings[i] % dt
+            for k in range(template_length):
+                pulse_current[start + k] += pmt_current_templates[reminder, k] * photon_gains[i]
+
+    @staticmethod
+    def add_current_fft(photon_timings,
+                        photon_gains,
+                        pulse_left,
+                        dt,
+                        pmt_current_templates,
+                        pulse_current):
+        """
+        Same as add_current, but histogram the gains per (sample, reminder) and
+        convolve each reminder row with its spe template using fft
+        """
+        if not len(photon_timings):
+            return
+
+        n_samples = len(pulse_current)
+        n_reminders = len(pmt_current_templates)
+        start = photon_timings // dt - pulse_left
+        reminder = photon_timings % dt
+        gain_hist = np.bincount(reminder * n_samples + start,
+                                weights=photon_gains,
+                                minlength=n_reminders * n_samples).reshape(n_reminders, n_samples)
+        pulse_current += fftconvolve(gain_hist, pmt_current_templates, axes=1)[:, :n_samples].sum(axis=0)
 
     @staticmethod
     def singlet_triplet_delays(size, singlet_ratio, config, phase):
@@ -267,8 +367,8 @@ class Pulse(object):
             t1, t3 = (config['singlet_lifetime_gas'],
                       config['triplet_lifetime_gas'])
 
-        delay = np.random.choice([t1, t3], size, replace=True,
-                                 p=[singlet_ratio, 1 - singlet_ratio])
+        # Bernoulli draw of singlet vs triplet, cheaper than np.random.choice
+        delay = np.where(np.random.random(size) < singlet_ratio, t1, t3)
         return np.random.exponential(1, size) * delay
 
 
@@ -301,7 +401,7 @@ class S1(Pulse):
                                         s1_light_yield_map=self.resource.s1_light_yield_map,
                                         config=self.config)
 
-        self._photon_timings = self.photon_timings(t, n_photons, recoil_type, self.config)
+        self._photon_timings = self.photon_timings(t, n_photons, recoil_type, self.config, self.phase)
         # The new way iterpolation is written always require a list
         self._photon_channels = self.photon_channels(positions, n_photons, self.config, self.resource.s1_pattern_map)
 
@@ -324,78 +424,116 @@ class S1(Pulse):
         p_per_channel = s1_pattern_map(points)
         p_per_channel[:, np.in1d(channels, config['turned_off_pmts'])] = 0
         
-        _photon_channels = np.array([]).astype(int)
-        for ppc, n in zip(p_per_channel, n_photons):
-            _photon_channels = np.append(_photon_channels,
-                    np.random.choice(
-                        channels,
-                        size=n,
-                        p=ppc / np.sum(ppc),
-                        replace=True))
+        # Fill a preallocated array instead of growing it with np.append
+        offsets = np.concatenate(([0], np.cumsum(n_photons)))
+        _photon_channels = np.empty(offsets[-1], dtype=int)
+        for i, (ppc, n) in enumerate(zip(p_per_channel, n_photons)):
+            _photon_channels[offsets[i]:offsets[i+1]] = np.random.choice(
+                channels,
+                size=n,
+                p=ppc / np.sum(ppc),
+                replace=True)
         return _photon_channels
 
     @staticmethod
-    def photon_timings(t, n_photons, recoil_type, config):
-        if n_photons == 0:
+    def photon_timings(t, n_photons, recoil_type, config, phase):
+        """
+        Photon timings of all S1 instructions, sampled in a single njit pass
+        t              - dim-1 array of instruction times
+        n_photons      - dim-1 int array of number of photons per instruction
+        recoil_type    - dim-1 int array of nest ids per instruction
+        phase          - 'liquid' or 'gas'
+        """
+        n_photons = np.asarray(n_photons, dtype=np.int64)
+        if np.sum(n_photons) == 0:
             return np.array([])
+        t, recoil_type = np.asarray(t, dtype=np.float64), np.asarray(recoil_type)
+        _photon_timings = np.zeros(np.sum(n_photons))
+
+        # Simple S1 model enabled: use it for ER and NR instructions, the others
+        # keep the detailed model
+        simple = np.isin(recoil_type, NestId._ALL) & (config.get('s1_model_type') == 'simple')
+        photon_simple = np.repeat(simple, n_photons)
+        if np.any(simple):
+            _photon_timings[photon_simple] = np.repeat(t[simple], n_photons[simple]) \
+                + np.random.exponential(config['s1_decay_time'], np.sum(photon_simple))
+            _photon_timings[photon_simple] += np.random.normal(0, config['s1_decay_spread'],
+                                                               np.sum(photon_simple))
+            if np.all(simple):
+                return _photon_timings
+            t, n_photons, recoil_type = t[~simple], n_photons[~simple], recoil_type[~simple]
+
+        # 0: ER, 1: NR, 2: alpha
+        recoil_codes = np.full(len(t), -1, dtype=np.int64)
+        for code, nest_ids in enumerate([NestId.ER, NestId.NR, NestId.ALPHA]):
+            recoil_codes[np.isin(recoil_type, nest_ids)] = code
+        if np.any(recoil_codes < 0):
+            raise AttributeError(f"Recoil type must be ER, NR or alpha, "
+                                 f"not {np.unique(recoil_type[recoil_codes < 0])}. Check nest ids")
 
-        if (config.get('s1_model_type') == 'simple' and 
-           recoil_type in NestId._ALL):
-            # Simple S1 model enabled: use it for ER and NR.
-            _photon_timings = t + np.random.exponential(config['s1_decay_time'], n_photons)
-            _photon_timings += np.random.normal(0,config['s1_decay_spread'],len(_photon_timings))
-            return _photon_timings
-
-        #TODO Looks nice but don't know if this actually works
-        try:
-            recoil_types = [k for k in vars(NestId) if not k.startswith('_')]
-            for recoil in recoil_types:
-                if recoil in NestId.recoil:
-                    _photon_timings = t + getattr(S1, recoil_type.lower())(n_photons=n_photons,
-                                                                           config=config,
-                                                                           singlet_triplet_delays=Pulse.singlet_triplet_delays,
-                                                                           phase=self.phase)
-
-        except AttributeError:
-            raise AttributeError(f"Recoil type must be ER, NR, alpha or LED, not {recoil_type}. Check nest ids")
-
-    @staticmethod
-    def alpha(size,config, singlet_triplet_delays, phase):
-        # Neglible recombination time
-        return singlet_triplet_delays(size, config['s1_ER_alpha_singlet_fraction'],config, phase)
+        if phase == 'liquid':
+            t1, t3 = (config['singlet_lifetime_liquid'],
+                      config['triplet_lifetime_liquid'])
+        elif phase == 'gas':
+            t1, t3 = (config['singlet_lifetime_gas'],
+                      config['triplet_lifetime_gas'])
 
-    @staticmethod
-    def led(size,config, **kwargs):
-        # distribute photons uniformly within the LED pulse length
-        return np.random.uniform(0, config['led_pulse_length'], size)
+        # Only look up the parameters of recoil types that are actually simulated
+        # singlet_fractions: ER primary, ER secondary, NR, alpha
+        singlet_fractions = np.zeros(4)
+        reco_time = p_fraction = max_reco_time = 0.
+        if np.any(recoil_codes == 0):
+            # How many of these are primary excimers? Others arise through recombination.
+            efield = (config['drift_field'] / (units.V / units.cm))
+            config['s1_ER_recombination_time'] = 3.5 / \
+                                                 0.18 * (1 / 20 + 0.41) * np.exp(-0.009 * efield)
+            reco_time, p_fraction, max_reco_time = (
+                config['s1_ER_recombination_time'],
+                config['s1_ER_primary_singlet_fraction'],
+                config['maximum_recombination_time'])
+            singlet_fractions[0] = config['s1_ER_primary_singlet_fraction']
+            singlet_fractions[1] = config['s1_ER_secondary_singlet_fraction']
+        if np.any(recoil_codes == 1):
+            singlet_fractions[2] = config['s1_NR_singlet_fraction']
+        if np.any(recoil_codes == 2):
+            # Neglible recombination time
+            singlet_fractions[3] = config['s1_ER_alpha_singlet_fraction']
+
+        detailed = np.zeros(np.sum(n_photons))
+        S1._fill_s1_timings(t, n_photons, recoil_codes,
+                            singlet_fractions, t1, t3,
+                            reco_time, p_fraction, max_reco_time,
+                            detailed)
+        _photon_timings[~photon_simple] = detailed
+        return _photon_timings
 
     @staticmethod
-    def er(size,config, singlet_triplet_delays, phase):
-        # How many of these are primary excimers? Others arise through recombination.
-        efield = (config['drift_field'] / (units.V / units.cm))
-        config['s1_ER_recombination_time'] = 3.5 / \
-                                                  0.18 * (1 / 20 + 0.41) * np.exp(-0.009 * efield)
-
-        reco_time, p_fraction, max_reco_time = (
-            config['s1_ER_recombination_time'],
-            config['s1_ER_primary_singlet_fraction'],
-            config['maximum_recombination_time'])
-
-        timings = np.random.choice([0, reco_time], size, replace=True,
-                                   p=[p_fraction, 1 - p_fraction])
-        primary = timings == 0
-        timings *= 1 / (1 - np.random.uniform(0, 1, size)) - 1
-        timings = np.clip(timings, 0, config['maximum_recombination_time'])
-        size_primary = len(timings[primary])
-        timings[primary] += singlet_triplet_delays(
-            size_primary, config['s1_ER_primary_singlet_fraction'],config,phase)
-        timings[~primary] += singlet_triplet_delays(
-            size - size_primary, config['s1_ER_secondary_singlet_fraction'],config,phase)
-        return timings
+    @njit
+    def _fill_s1_timings(t, n_photons, recoil_codes, singlet_fractions, t1, t3,
+                         reco_time, p_fraction, max_reco_time, out):
+        i_photon = 0
+        for i in range(len(t)):
+            code = recoil_codes[i]
+            for _ in range(n_photons[i]):
+                delay = 0.
+                if code == 0:
+                    # ER: primary excimers or recombination with a delay
+                    if np.random.random() < p_fraction:
+                        singlet_fraction = singlet_fractions[0]
+                    else:
+                        delay = reco_time * (1 / (1 - np.random.random()) - 1)
+                        delay = min(delay, max_reco_time)
+                        singlet_fraction = singlet_fractions[1]
+                else:
+                    singlet_fraction = singlet_fractions[code + 1]
 
-    @staticmethod
-    def nr(size, config, singlet_triplet_delays, phase):
-        return singlet_triplet_delays(size, config['s1_NR_singlet_fraction'], config, phase)
+                # Singlet or triplet decay of the excimer
+                if np.random.random() < singlet_fraction:
+                    delay += np.random.exponential(t1)
+                else:
+                    delay += np.random.exponential(t3)
+                out[i_photon] = t[i] + delay
+                i_photon += 1
 
 
 @export
@@ -414,6 +552,10 @@ class S2(Pulse):
         self.phase = 'gas'  # To distinguish singlet/triplet time delay. This is based on electron spin
         self.luminescence_switch_threshold = 100  # When to use simplified model (NOT IN USE)?
 
+        # Scratch buffers for electron timings and gains, grown on demand and reused across events
+        self._scratch_e_timings = np.zeros(0)
+        self._scratch_e_gains = np.zeros(0)
+
     def __call__(self, instruction):
         if len(instruction.shape) < 1:
             # shape of recarr is a bit strange
@@ -455,20 +597,29 @@ class S2(Pulse):
         super().__call__()
 
     def inverse_field_distortion(self, x, y, z):
-        positions = np.array([x, y, z]).T
-        for i_iter in range(6):  # 6 iterations seems to work
+        # Fill one (N, 3) array in place instead of rebuilding it every iteration
+        positions = np.empty((len(x), 3))
+        positions[:, 0], positions[:, 1], positions[:, 2] = x, y, z
+        r = np.sqrt(x**2 + y**2)
+        tolerance = self.config.get('fdc_inverse_tolerance', 0.01)  # cm
+
+        for i_iter in range(6):  # 6 iterations seems to work, stop earlier once converged
             dr = self.resource.fdc_3d(positions)
-            if i_iter > 0: dr = 0.5 * dr + 0.5 * dr_pre  # Average between iter
+            if i_iter > 0:
+                dr = 0.5 * dr + 0.5 * dr_pre  # Average between iter
+                converged = len(dr) == 0 or np.max(np.abs(dr - dr_pre)) < tolerance
+            else:
+                converged = False
             dr_pre = dr
 
-            r_obs = np.sqrt(x**2 + y**2) - dr
-            x_obs = x * r_obs / (r_obs + dr)
-            y_obs = y * r_obs / (r_obs + dr)
-            z_obs = - np.sqrt(z**2 + dr**2)
-            positions = np.array([x_obs, y_obs, z_obs]).T
+            r_obs = r - dr
+            positions[:, 0] = x * r_obs / (r_obs + dr)
+            positions[:, 1] = y * r_obs / (r_obs + dr)
+            positions[:, 2] = - np.sqrt(z**2 + dr**2)
+            if converged:
+                break
 
-        positions = np.array([x_obs, y_obs]).T 
-        return z_obs, positions
+        return positions[:, 2], positions[:, :2]
 
     @staticmethod
     @njit
@@ -522,14 +673,6 @@ class S2(Pulse):
         return self._luminescence_timings_simple(len(xy), dG, E0, 
             r, dr, rr, alpha, uE, pressure, n_electron, shape)
 
-    @staticmethod
-    @njit
-    def _luminescence_timings_garfield(distance, x_grid, n_grid, i_grid, shape, index):
-        for ix in range(shape[0]):
-            pitch_index = np.argmin(np.abs(distance[ix] - x_grid))
-            for iy in range(shape[1]):
-                index[ix, iy] = i_grid[pitch_index] + np.random.randint(n_grid[pitch_index])
-
     def luminescence_timings_garfield(self, xy, shape):
         """
         Luminescence time distribution computation
@@ -547,14 +690,20 @@ class S2(Pulse):
         jagged = lambda relative_y: (relative_y + pitch / 2) % pitch - pitch / 2
         distance = jagged(np.matmul(xy, rotation_mat)[:, 1])  # shortest distance from any wire
 
-        index = np.zeros(shape).astype(int)
+        # x_grid is sorted by np.unique, so find the closest grid point by bisection,
+        # stepping back to the left neighbour when it is at least as close (like argmin)
+        pitch_index = np.zeros(len(distance), dtype=int)
+        if len(x_grid) > 1:
+            pitch_index = np.clip(np.searchsorted(x_grid, distance, side='left'), 1, len(x_grid) - 1)
+            pitch_index -= (distance - x_grid[pitch_index - 1]) <= (x_grid[pitch_index] - distance)
 
-        self._luminescence_timings_garfield(distance, x_grid, n_grid, i_grid, shape, index)
+        index = i_grid[pitch_index][:, None] + np.random.randint(
+            n_grid[pitch_index][:, None], size=shape)
 
         return self.resource.s2_luminescence['t'][index]
 
     @staticmethod
-    @njit
+    @njit(parallel=True, nogil=True, cache=True)
     def electron_timings(t, n_electron, z, sc_gain, timings, gains,
             drift_velocity_liquid,
             drift_time_gate,
@@ -564,8 +713,9 @@ class S2(Pulse):
         assert len(gains) == np.sum(n_electron)
         assert len(sc_gain) == len(t)
 
-        i_electron = 0
-        for i in np.arange(len(t)):
+        # Output offset of each instruction, so instructions can be filled independently
+        starts = np.cumsum(n_electron) - n_electron
+        for i in prange(len(t)):
             # Diffusion model from Sorensen 2011
             drift_time_mean = - z[i] / \
                 drift_velocity_liquid + drift_time_gate
@@ -574,7 +724,8 @@ class S2(Pulse):
             drift_time_stdev /= drift_velocity_liquid
             # Calculate electron arrival times in the ELR region
 
-            for _ in np.arange(n_electron[i]):
+            for j in range(n_electron[i]):
+                i_electron = starts[i] + j
                 _timing = t[i] + \
                     np.random.exponential(electron_trapping_time)
                 _timing += np.random.normal(drift_time_mean, drift_time_stdev)
@@ -582,12 +733,15 @@ class S2(Pulse):
 
                 # TODO: add manual fluctuation to sc gain
                 gains[i_electron] = sc_gain[i]
-                i_electron += 1
 
     def photon_timings(self, t, n_electron, z, xy, sc_gain):
-        # First generate electron timinga
-        self._electron_timings = np.zeros(np.sum(n_electron))
-        self._electron_gains = np.zeros(np.sum(n_electron))
+        # First generate electron timinga, every element is filled by electron_timings
+        n_total = np.sum(n_electron)
+        if len(self._scratch_e_timings) < n_total:
+            self._scratch_e_timings = np.zeros(int(n_total * 1.5))
+            self._scratch_e_gains = np.zeros(int(n_total * 1.5))
+        self._electron_timings = self._scratch_e_timings[:n_total]
+        self._electron_gains = self._scratch_e_gains[:n_total]
         _config = [self.config[k] for k in
                    ['drift_velocity_liquid',
                     'drift_time_gate',
@@ -612,17 +766,19 @@ class S2(Pulse):
             self._photon_timings = self.luminescence_timings_garfield(
                 np.repeat(xy, n_electron, axis=0),
                 (nele, npho))
-        self._photon_timings += np.repeat(self._electron_timings, npho).reshape((nele, npho))
+        self._photon_timings += self._electron_timings[:, None]
 
         # Crop number of photons by random number generated with poisson
-        probability = np.tile(np.arange(npho), nele).reshape((nele, npho))
-        threshold = np.repeat(np.random.poisson(self._electron_gains), npho).reshape((nele, npho))
-        self._photon_timings = self._photon_timings[probability < threshold]
+        # Broadcast (1, npho) against (nele, 1) instead of materializing both as (nele, npho)
+        probability = np.arange(npho)[None, :]
+        threshold = np.random.poisson(self._electron_gains)[:, None]
+        mask = probability < threshold
+        self._photon_timings = self._photon_timings[mask]
 
-        # Index to match photon with poistion input
-        self._instruction = np.repeat(
-            np.repeat(np.arange(len(t)), n_electron), npho).reshape((nele, npho))
-        self._instruction = self._instruction[probability < threshold]
+        # Index to match photon with poistion input, mask keeps min(threshold, npho) photons
+        # per electron in row order so repeating the electron's instruction is equivalent
+        self._instruction = np.repeat(np.repeat(np.arange(len(t)), n_electron),
+                                      np.minimum(threshold[:, 0], npho))
 
         self._photon_timings += self.singlet_triplet_delays(
             len(self._photon_timings), self.config['singlet_fraction_gas'],self.config, self.phase)
@@ -632,14 +788,21 @@ class S2(Pulse):
 
         # The timings generated is NOT randomly ordered, must do shuffle
         # Shuffle within each given n_electron[i]
-        # We can do this by first finding out cumulative sum of the photons
-        cumulate_npho = np.pad(np.cumsum(threshold[:, 0]), [1, 0])[np.cumsum(n_electron)]
-        for i in range(len(cumulate_npho)):
-            if i == 0:
-                s = slice(0, cumulate_npho[i])
-            else:
-                s = slice(cumulate_npho[i-1], cumulate_npho[i])
-            np.random.shuffle(self._photon_timings[s])
+        # Photons are grouped by instruction already, so sort on random keys within each group
+        keys = np.random.random(len(self._photon_timings))
+        self._photon_timings = self._photon_timings[np.lexsort((keys, self._instruction))]
+
+    @staticmethod
+    def _afterpulse_instruction(signal_instruction, n_electron):
+        """
+        Allocate n_electron electron afterpulse instructions, copying the fields of
+        signal_instruction that are not set by electron_afterpulse (e.g. event_number)
+        """
+        instruction = np.zeros(n_electron, dtype=signal_instruction.dtype)
+        for field in signal_instruction.dtype.names:
+            if field not in ('type', 'time', 'x', 'y', 'z', 'amp'):
+                instruction[field] = signal_instruction[field]
+        return instruction
 
     def s2_pattern_map_diffuse(self, n_electron, z, xy):
         """Returns an array of pattern of shape [n interaction, n PMTs]
@@ -707,27 +870,28 @@ class S2(Pulse):
         assert pattern.shape[0] == len(positions)
         assert pattern.shape[1] == len(channels)
 
-        self._photon_channels = np.array([], dtype=int)
-        # Randomly assign to channel given probability of each channel
-        for unique_i, count in zip(*np.unique(self._instruction, return_counts=True)):
-            pat = pattern[unique_i]  # [pmt]
-
-            if aft > 0:  # Redistribute pattern with user specified aft
-                _aft = aft * (1 + np.random.normal(0, aft_random))
-                _aft = np.clip(_aft, 0, 1)
-                pat[top_index] = pat[top_index] / pat[top_index].sum() * _aft
-                pat[bottom_index] = pat[bottom_index] / pat[bottom_index].sum() *  (1 - _aft)
+        if aft > 0:  # Redistribute pattern with user specified aft
+            _aft = aft * (1 + np.random.normal(0, aft_random, len(pattern)))
+            _aft = np.clip(_aft, 0, 1)[:, None]
+            pattern[:, top_index] = pattern[:, top_index] \
+                / pattern[:, top_index].sum(axis=1, keepdims=True) * _aft
+            pattern[:, bottom_index] = pattern[:, bottom_index] \
+                / pattern[:, bottom_index].sum(axis=1, keepdims=True) * (1 - _aft)
 
-            if np.isnan(pat).sum() > 0:  # Pattern map return zeros
-                _photon_channels = np.array([-1] * count)
-            else:
-                _photon_channels = np.random.choice(
-                    channels,
-                    size=count,
-                    p=pat,
-                    replace=True)
-
-            self._photon_channels = np.append(self._photon_channels, _photon_channels)
+        # Randomly assign to channel given probability of each channel
+        # All photons are sampled at once, by stacking the cdfs of the instructions
+        # into one monotonic array where the cdf of instruction i spans [i, i + 1]
+        cdf = np.cumsum(pattern, axis=1)
+        invalid = np.isnan(cdf[:, -1]) | (cdf[:, -1] <= 0)  # Pattern map return zeros
+        cdf[invalid] = 1
+        cdf /= cdf[:, -1:]
+        stacked_cdf = (cdf + np.arange(len(cdf))[:, None]).ravel()
+
+        rows = np.asarray(self._instruction)
+        u = np.random.random(len(rows))
+        index = np.searchsorted(stacked_cdf, rows + u, side='right') - rows * len(channels)
+        self._photon_channels = channels[np.clip(index, 0, len(channels) - 1)]
+        self._photon_channels[invalid[rows]] = -1
 
         # Remove photon with channel -1
         mask = self._photon_channels != -1
@@ -769,7 +933,7 @@ class PhotoIonization_Electron(S2):
             low=0, high=len(signal_pulse._photon_timings),
             size=n_electron)]
 
-        instruction = np.repeat(signal_pulse_instruction[0], n_electron)
+        instruction = self._afterpulse_instruction(signal_pulse_instruction[0], n_electron)
 
         instruction['type'] = 4 # pi_el
         instruction['time'] = t_zeros
@@ -809,17 +973,21 @@ class PhotoElectric_Electron(S2):
                                        * len(signal_pulse._photon_timings)
                                        * self.config['photoelectric_modifier'])
 
-        ap_delay = np.clip(
-            np.random.normal(self.config['photoelectric_t_center'] + self.config['drift_time_gate'], 
-                             self.config['photoelectric_t_spread'],
-                             n_electron), 0, None)
+        # Normal delays truncated at zero, sampled by inverting the cdf above zero
+        # rather than clipping (which would pile the negative tail up at zero)
+        mu = self.config['photoelectric_t_center'] + self.config['drift_time_gate']
+        sigma = self.config['photoelectric_t_spread']
+        if sigma > 0:
+            ap_delay = mu + sigma * ndtri(np.random.uniform(ndtr(-mu / sigma), 1, n_electron))
+        else:
+            ap_delay = np.full(n_electron, max(mu, 0))
 
         # Randomly select original photon as time zeros
         t_zeros = signal_pulse._photon_timings[np.random.randint(
             low=0, high=len(signal_pulse._photon_timings),
             size=n_electron)]
 
-        instruction = np.repeat(signal_pulse_instruction[0], n_electron)
+        instruction = self._afterpulse_instruction(signal_pulse_instruction[0], n_electron)
 
         instruction['type'] = 6 # pe_el
         instruction['time'] = t_zeros
@@ -848,16 +1016,14 @@ class PMT_Afterpulse(Pulse):
 
     def __init__(self, config):
         super().__init__(config)
+        self._gains = np.asarray(self.config['gains'], dtype=float)
+        self._inverse_cdfs = dict()  # Built per element on first use, see inverse_cdf_table
 
     def __call__(self, signal_pulse):
         if len(signal_pulse._photon_timings) == 0:
             self.clear_pulse_cache()
             return
 
-        self._photon_timings = []
-        self._photon_channels = []
-        self._photon_amplitude = []
-
         self.photon_afterpulse(signal_pulse)
         super().__call__()
 
@@ -865,6 +1031,8 @@ class PMT_Afterpulse(Pulse):
         """
         For pmt afterpulses, gain and dpe generation is a bit different from standard photons
         """
+        timings_chunks, channels_chunks, amplitude_chunks = [], [], []
+
         self.element_list = self.resource.uniform_to_pmt_ap.keys()
         for element in self.element_list:
             delaytime_cdf = self.resource.uniform_to_pmt_ap[element]['delaytime_cdf']
@@ -888,25 +1056,62 @@ class PMT_Afterpulse(Pulse):
                     delaytime_cdf[sel_photon_channel, 1])                
                 ap_amplitude = np.ones_like(ap_delay)
             else:
-                ap_delay = (np.argmin(
-                    np.abs(
-                        delaytime_cdf[sel_photon_channel]
-                        - rU0[sel_photon_id][:, None]), axis=-1)
-                            - self.config['pmt_ap_t_modifier'])
-                ap_amplitude = np.argmin(
-                    np.abs(
-                        amplitude_cdf[sel_photon_channel]
-                        - rU1[:, None]), axis=-1)/100.
-
-            self._photon_timings += (signal_pulse._photon_timings[sel_photon_id] + ap_delay).tolist()
-            self._photon_channels += signal_pulse._photon_channels[sel_photon_id].tolist()
-            self._photon_amplitude += np.atleast_1d(ap_amplitude).tolist()
-
-        self._photon_timings = np.array(self._photon_timings)
-        self._photon_channels = np.array(self._photon_channels).astype(int)
-        self._photon_amplitude = np.array(self._photon_amplitude)
-        self._photon_gain = np.array(self.config['gains'])[self._photon_channels] \
-            * self._photon_amplitude
+                if element not in self._inverse_cdfs:
+                    n_points = self.config.get('pmt_ap_inverse_cdf_points', 4096)
+                    self._inverse_cdfs[element] = (self.inverse_cdf_table(delaytime_cdf, n_points),
+                                                   self.inverse_cdf_table(amplitude_cdf, n_points))
+                inv_delay, inv_amplitude = self._inverse_cdfs[element]
+
+                # Invert the cdfs by a lookup on the uniform grid, u beyond the cdf maximum
+                # (pmt_ap_modifier > 1) maps to the first bin where the cdf reaches its maximum
+                ap_delay = self.inverse_cdf_lookup(inv_delay, sel_photon_channel, rU0[sel_photon_id],
+                                                   delaytime_cdf[sel_photon_channel, -1])
+                ap_delay -= self.config['pmt_ap_t_modifier']
+                ap_amplitude = self.inverse_cdf_lookup(inv_amplitude, sel_photon_channel, rU1,
+                                                       amplitude_cdf[sel_photon_channel, -1]) / 100.
+
+            timings_chunks.append(signal_pulse._photon_timings[sel_photon_id] + ap_delay)
+            channels_chunks.append(sel_photon_channel)
+            amplitude_chunks.append(ap_amplitude)
+
+        # Concatenate once rather than growing python lists per element
+        self._photon_timings = np.concatenate(timings_chunks) if timings_chunks else np.zeros(0)
+        self._photon_channels = np.concatenate(channels_chunks).astype(int) \
+            if channels_chunks else np.zeros(0, dtype=int)
+        self._photon_amplitude = np.concatenate(amplitude_chunks) if amplitude_chunks else np.zeros(0)
+        self._photon_gain = np.take(self._gains, self._photon_channels) * self._photon_amplitude
+
+    @staticmethod
+    def inverse_cdf_table(cdf, n_points):
+        """
+        Tabulate the inverse of each row of cdf on n_points uniform steps between 0 and
+        the maximum of the row, the cdfs are indexed by delay time in ns (or amplitude * 100).
+        The inverse is the first bin where the cdf reaches u, which is well defined on the
+        flat parts of the cdfs; u at the maximum gives the first bin at the maximum
+        cdf      - dim-2 float array, one non-decreasing cdf per channel
+        n_points - number of points on the uniform grid
+        """
+        u_grid = np.linspace(0, 1, n_points)
+        table = np.zeros((len(cdf), n_points), dtype=np.int32)
+        for ch, row in enumerate(cdf.astype(np.float64)):
+            # Compare in float64 so float32 cdfs do not depend on numpy's casting rules
+            if row[-1] > 0:
+                table[ch] = np.searchsorted(row, u_grid * row[-1], side='left')
+        return table
+
+    @staticmethod
+    def inverse_cdf_lookup(table, channels, u, cdf_max):
+        """
+        Sample the inverse cdf tables from inverse_cdf_table for uniform random numbers u
+        table    - dim-2 int array from inverse_cdf_table
+        channels - dim-1 int array of channel per random number
+        u        - dim-1 float array of uniform random numbers
+        cdf_max  - dim-1 float array of the maximum of the cdf of each channel
+        """
+        n_points = table.shape[1]
+        k = np.rint(u / np.where(cdf_max > 0, cdf_max, 1) * (n_points - 1))
+        k = np.clip(k, 0, n_points - 1).astype(np.int32)
+        return table[channels, k].astype(np.float64)
 
 
 @export
@@ -922,6 +1127,36 @@ class RawData(object):
             pmt_ap=PMT_Afterpulse(config),
         )
         self.resource = load_config(self.config)
+        self.init_digitizer_constants()
+
+    def init_digitizer_constants(self):
+        """
+        Look up the constants used by digitize_pulse_cache once, rather than per call
+        """
+        self.current_2_adc = self.config['pmt_circuit_load_resistor'] \
+            * self.config['external_amplification'] \
+            / (self.config['digitizer_voltage_range'] / 2 ** (self.config['digitizer_bits']))
+
+        # For XENONnT the top channels are copied to the high energy channels, and the
+        # bottom channels summed into the sum signal. _he_row_of_ch is the row each channel
+        # is added to (after deamplification), -1 if none
+        self._is_nt = self.config['detector'] == 'XENONnT'
+        self._he_row_of_ch = np.full(801, -1, dtype=np.int64)
+        if self._is_nt:
+            self._n_top_pmts = self.config['n_top_pmts']
+            self._he_map = np.arange(self.config['channel_map']['he'][0],
+                                     self.config['channel_map']['he'][1] + 1, dtype=np.int64)
+            self._he_factor = int(self.config['high_energy_deamplification_factor'])
+            self._sum_signal_row = self.config['channel_map']['sum_signal']
+            self._he_row_of_ch[:self._n_top_pmts] = self._he_map[:self._n_top_pmts]
+            self._he_row_of_ch[self._n_top_pmts:self.config['channels_bottom'][-1] + 1] = self._sum_signal_row
+        else:
+            self._n_top_pmts = self._he_factor = self._sum_signal_row = 0
+            self._he_map = np.zeros(0, dtype=np.int64)
+
+        # Samples per channel of raw data scratch buffer kept between chunks (801 int32 rows,
+        # about 320 MB at the default), longer chunks get a buffer of their own
+        self._raw_data_max_width = int(self.config.get('raw_data_buffer_max_samples', 100000))
 
     def __call__(self, instructions, truth_buffer=None, **kwargs):
         if truth_buffer is None:
@@ -944,27 +1179,38 @@ class RawData(object):
         # thus type%2-1 is 0:S1-esque;  -1:S2-esque
         # Make a list of clusters of instructions, with gap smaller then rext
         inst_time = instructions['time'] + instructions['z']  / v * (instructions['type'] % 2 - 1)
-        inst_queue = np.argsort(inst_time)
-        inst_queue = np.split(inst_queue, np.where(np.diff(inst_time[inst_queue]) > rext)[0]+1)
+        # Keep the sorted order and the cluster bounds, clusters are taken from them one by one
+        inst_order = np.argsort(inst_time, kind='stable')
+        inst_bounds = np.concatenate(([0],
+                                      np.nonzero(np.diff(inst_time[inst_order]) > rext)[0] + 1,
+                                      [len(inst_order)]))
+        n_clusters, i_cluster = len(inst_bounds) - 1, 0
 
         # Instruction buffer
         instb = np.zeros(10000, dtype=instructions.dtype) # size ~ 1% of size of primary
         instb_filled = np.zeros_like(instb, dtype=bool) # Mask of where buffer is filled
+        # Stack of free buffer slots, the lowest slots are on top to start with
+        free_stack = np.arange(len(instb))[::-1].copy()
+        free_top = len(instb)
 
         # ik those are illegible, messy logic. lmk if you have a better way
-        pbar = tqdm(total=len(inst_queue), desc='Simulating Raw Records')
+        pbar = tqdm(total=n_clusters, desc='Simulating Raw Records')
         while not self.source_finished:
 
             # A) Add a new instruction into buffer
-            try:
-                ixs = inst_queue.pop(0) # The index from original instruction list
-                self.source_finished = len(inst_queue) == 0
-                assert len(np.where(~instb_filled)[0]) > len(ixs), "Run out of instruction buffer"
-                ib = np.where(~instb_filled)[0][:len(ixs)] # The index of first empty slot in buffer
-                instb[ib] = instructions[ixs]
-                instb_filled[ib] = True
-                pbar.update(1)
-            except: pass
+            if i_cluster < n_clusters:
+                try:
+                    # The index from original instruction list
+                    ixs = inst_order[inst_bounds[i_cluster]:inst_bounds[i_cluster + 1]]
+                    i_cluster += 1
+                    self.source_finished = i_cluster == n_clusters
+                    assert free_top > len(ixs), "Run out of instruction buffer"
+                    ib = free_stack[free_top - len(ixs):free_top] # Pop free slots from the stack
+                    free_top -= len(ixs)
+                    instb[ib] = instructions[ixs]
+                    instb_filled[ib] = True
+                    pbar.update(1)
+                except: pass
 
             # B) Cluster instructions again with gap size <= rext
             instb_indx = np.where(instb_filled)[0]
@@ -996,7 +1242,9 @@ class RawData(object):
                     # Run pulse simulation for real
                     for instb_run in _instb_run:
                         for instb_secondary in self.sim_data(instb[instb_run]):
-                            ib = np.where(~instb_filled)[0][:len(instb_secondary)]
+                            assert free_top >= len(instb_secondary), "Run out of instruction buffer"
+                            ib = free_stack[free_top - len(instb_secondary):free_top]
+                            free_top -= len(instb_secondary)
                             instb[ib] = instb_secondary
                             instb_filled[ib] = True
 
@@ -1004,13 +1252,15 @@ class RawData(object):
                             self.get_truth(instb[instb_run], truth_buffer)
 
                         instb_filled[instb_run] = False # Free buffer AFTER copyting into truth buffer
+                        free_stack[free_top:free_top + len(instb_run)] = instb_run
+                        free_top += len(instb_run)
 
                 if stop_at_this_group: 
                     break
                 self.digitize_pulse_cache() # from pulse cache to raw data
                 yield from self.ZLE()
                 
-            self.source_finished = len(inst_queue) == 0 and np.sum(instb_filled) == 0
+            self.source_finished = i_cluster == n_clusters and free_top == len(instb)
         pbar.close()
 
     @staticmethod
@@ -1039,11 +1289,12 @@ class RawData(object):
                 continue
 
             _pulses = getattr(self.pulses[pt], '_pulses')
-            if len(_pulses) > 0:
-                self._pulses_cache += _pulses
+            if len(_pulses['channel']) > 0:
+                # Keep a list of pulse chunks, merged only once in digitize_pulse_cache
+                self._pulses_cache.append(_pulses)
                 self.last_pulse_end_time = max(
                     self.last_pulse_end_time,
-                    np.max([p['right'] for p in _pulses]) * 10)
+                    self.pulses[pt].max_right * 10)
 
         # Make new instructions for electron afterpulses, if requested
         if primary_pulse in ['s1', 's2']:
@@ -1062,105 +1313,100 @@ class RawData(object):
         if len(self._pulses_cache) == 0:
             self._raw_data = []
         else:
-            self.current_2_adc = self.config['pmt_circuit_load_resistor'] \
-                * self.config['external_amplification'] \
-                / (self.config['digitizer_voltage_range'] / 2 ** (self.config['digitizer_bits']))
-
-            self.left = np.min([p['left'] for p in self._pulses_cache]) - self.config['trigger_window']
-            self.right = np.max([p['right'] for p in self._pulses_cache]) + self.config['trigger_window']
+            pulses = _concatenate_pulses(self._pulses_cache)
+            self.left = pulses['left'].min() - self.config['trigger_window']
+            self.right = pulses['right'].max() + self.config['trigger_window']
             assert self.right - self.left < 1000000, "Pulse cache too long"
 
             if self.left % 2 != 0: self.left -= 1 # Seems like a digizier effect
 
 
-            self._raw_data = np.zeros((801,
-                self.right - self.left + 1), dtype=('<i8'))
+            # int32 is plenty for the (pre-baseline, possibly he-amplified) adc counts,
+            # int16 would wrap for large pulses before finalize_channels clips them
+            # Reuse one scratch buffer, only zeroing the rows written to last time,
+            # it is only kept while it fits within _raw_data_max_width samples
+            width = self.right - self.left + 1
+            scratch = getattr(self, '_raw_data_scratch', None)
+            if scratch is None or scratch.shape[1] < width:
+                scratch = np.zeros((801, max(width, min(int(width * 1.5), self._raw_data_max_width))),
+                                   dtype=('<i4'))
+                self._raw_data_scratch = scratch if scratch.shape[1] <= self._raw_data_max_width else None
+            else:
+                scratch[self._raw_data_rows, :self._raw_data_width] = 0
+            self._raw_data = scratch[:, :width]
                                                  
             # Use this mask to by pass non-activated channels
             # Set to true when working with real noise
             self._channel_mask = np.zeros(801, dtype=[('mask', '?'), ('left', 'i8'), ('right', 'i8')])
             self._channel_mask['left'] = int(2**63-1)
 
-            for _pulse in self._pulses_cache:
-                ch = _pulse['channel']
-                self._channel_mask['mask'][ch] = True
-                self._channel_mask['left'][ch] = min(_pulse['left'], self._channel_mask['left'][ch])
-                self._channel_mask['right'][ch] = max(_pulse['right'], self._channel_mask['right'][ch])
-                adc_wave = - np.trunc(_pulse['current'] * self.current_2_adc).astype(int)
-                _slice = slice(_pulse['left'] - self.left, _pulse['right'] - self.left + 1)
-                
-                self._raw_data[ch, _slice] += adc_wave
-
-                if self.config['detector'] == 'XENONnT':
-                    adc_wave_he = adc_wave * int(self.config['high_energy_deamplification_factor'])
-                    if ch < self.config['n_top_pmts']:
-                        ch_he = np.arange(self.config['channel_map']['he'][0],self.config['channel_map']['he'][1]+1)[ch]
-                        self._raw_data[ch_he, _slice] += adc_wave_he
-                        self._channel_mask[ch_he] = True
-                        self._channel_mask['left'][ch_he] = self._channel_mask['left'][ch]
-                        self._channel_mask['right'][ch_he] = self._channel_mask['right'][ch]
-                    elif ch <= self.config['channels_bottom'][-1]:
-                        self.sum_signal(adc_wave_he,
-                            _pulse['left'] - self.left,
-                            _pulse['right'] - self.left + 1,
-                            self._raw_data[self.config['channel_map']['sum_signal']])
+            # Superimpose the pulses with numba, walking them by channel then left
+            # so each row of raw data is written in one streaming pass
+            pulse_offsets = np.concatenate(([0], np.cumsum(pulses['duration'])))
+            pulse_order = np.lexsort((pulses['left'], pulses['channel']))
+
+            self._accumulate_pulses(
+                self._raw_data, self._channel_mask,
+                pulses['left'], pulses['right'], pulses['channel'], pulses['current'], pulse_offsets,
+                pulse_order,
+                np.float64(self.current_2_adc), self.left,
+                self._he_row_of_ch, self._he_factor)
+
+            # High energy channels span the same range as their top channel
+            if self._is_nt:
+                top = np.nonzero(self._channel_mask['mask'][:self._n_top_pmts])[0]
+                self._channel_mask[self._he_map[top]] = self._channel_mask[top]
 
             self._pulses_cache = []
 
+            # Rows to zero before the scratch buffer is used again, the sum signal is not masked
+            self._raw_data_rows = np.nonzero(self._channel_mask['mask'])[0]
+            if self._is_nt:
+                self._raw_data_rows = np.append(self._raw_data_rows, self._sum_signal_row)
+            self._raw_data_width = width
+
             self._channel_mask['left'] -= self.left + self.config['trigger_window']
             self._channel_mask['right'] -= self.left - self.config['trigger_window']
             
             
             # Adding noise, baseline and digitizer saturation
             
-            if self.config.get('enable_noise', True):
-                self.add_noise(data=self._raw_data,
-                            channel_mask=self._channel_mask,
-                            noise_data=self.resource.noise_data,
-                            noise_data_length=len(self.resource.noise_data))
-            self.add_baseline(self._raw_data, self._channel_mask, 
-                    self.config['digitizer_reference_baseline'],)
-            self.digitizer_saturation(self._raw_data, self._channel_mask)
+            # All in one pass over the data, see finalize_channels
+            enable_noise = self.config.get('enable_noise', True)
+            noise_offsets = self.noise_offsets(self._channel_mask, len(self.resource.noise_data)) \
+                if enable_noise else np.zeros(len(self._channel_mask), dtype=np.int64)
+            self.finalize_channels(self._raw_data, self._channel_mask,
+                                   self.resource.noise_data, len(self.resource.noise_data),
+                                   self.config['digitizer_reference_baseline'],
+                                   enable_noise, noise_offsets)
 
 
     def ZLE(self):
         """
         Modified software zero lengh encoding, coverting WFs into pulses (XENON definition)
         """
-        # Ask for memory allocation just once
-        if 'zle_intervals_buffer' not in self.__dict__:
-            self.zle_intervals_buffer = -1 * np.ones((50000, 2), dtype=np.int64)
-
-        for ix, data in enumerate(self._raw_data):
-            if not self._channel_mask['mask'][ix]:
-                continue
-            channel_left, channel_right = self._channel_mask['left'][ix], self._channel_mask['right'][ix]
-            data = data[channel_left:channel_right+1]
-
-            # For simulated data taking reference baseline as baseline
-            # Operating directly on digitized downward waveform        
-            if str(ix) in self.config.get('special_thresholds', {}):
-                threshold = self.config['digitizer_reference_baseline'] \
-                    - self.config['special_thresholds'][str(ix)] - 1
-            else:
-                threshold = self.config['digitizer_reference_baseline'] - self.config['zle_threshold'] - 1
-
-            n_itvs_found = find_intervals_below_threshold(
-                data,
-                threshold=threshold,
-                holdoff=self.config['trigger_window'] + self.config['trigger_window'] + 1,
-                result_buffer=self.zle_intervals_buffer,)
-
-            itvs_to_encode = self.zle_intervals_buffer[:n_itvs_found]
-            itvs_to_encode[:, 0] -= self.config['trigger_window']
-            itvs_to_encode[:, 1] += self.config['trigger_window']
-            itvs_to_encode = np.clip(itvs_to_encode, 0, len(data) - 1)
-            # Land trigger window on even numbers
-            itvs_to_encode[:, 0] = np.ceil(itvs_to_encode[:, 0] / 2.0) * 2
-            itvs_to_encode[:, 1] = np.floor(itvs_to_encode[:, 1] / 2.0) * 2
+        if len(self._raw_data) == 0:
+            return
 
-            for itv in itvs_to_encode:
-                yield ix, self.left + channel_left + itv[0], self.left + channel_left + itv[1], data[itv[0]:itv[1]+1]
+        # For simulated data taking reference baseline as baseline
+        # Operating directly on digitized downward waveform
+        thresholds = np.full(len(self._raw_data),
+                             self.config['digitizer_reference_baseline'] - self.config['zle_threshold'] - 1,
+                             dtype=np.int64)
+        for ch, special_threshold in self.config.get('special_thresholds', {}).items():
+            if int(ch) < len(thresholds):
+                thresholds[int(ch)] = self.config['digitizer_reference_baseline'] - special_threshold - 1
+
+        # Find the intervals of all channels in one numba call, and only yield from python
+        intervals = zle_intervals(self._raw_data, self._channel_mask, thresholds,
+                                  self.config['trigger_window'] + self.config['trigger_window'] + 1,
+                                  self.config['trigger_window'])
+
+        for ix, left, right in intervals:
+            channel_left = self._channel_mask['left'][ix]
+            # Copy, the raw data buffer is reused by the next digitize_pulse_cache
+            yield ix, self.left + channel_left + left, self.left + channel_left + right, \
+                self._raw_data[ix, channel_left + left:channel_left + right + 1].copy()
 
     def get_truth(self, instruction, truth_buffer):
         """Write truth in the first empty row of truth_buffer
@@ -1225,44 +1471,57 @@ class RawData(object):
 
     @staticmethod
     @njit
-    def sum_signal(adc_wave, left, right, sum_template):
-        sum_template[left:right] += adc_wave
-        return sum_template
-
-    @staticmethod
-    @njit
-    def add_noise(data, channel_mask, noise_data, noise_data_length):
+    def _accumulate_pulses(raw_data, channel_mask,
+                           pulse_left, pulse_right, pulse_channel, pulse_current, pulse_offsets,
+                           pulse_order, current_2_adc, left, he_row_of_ch, he_factor):
         """
-        Get chunk(s) of noise sample from real noise data
+        Add the adc waveform of each pulse to raw_data and update the channel mask
+        pulse_current holds the currents of all pulses back to back, pulse i spans
+        pulse_offsets[i]:pulse_offsets[i + 1], and pulses are added in pulse_order.
+        Channels with he_row_of_ch[ch] >= 0 are also added to that row times he_factor
         """
-        for ch in range(data.shape[0]):
-            if not channel_mask['mask'][ch]:
-                continue
-            left, right = channel_mask['left'][ch], channel_mask['right'][ch]
-            id_t = np.random.randint(low=0, high=noise_data_length-right+left)
-            for ix in range(left, right+1):
-                if id_t+ix >= noise_data_length or ix >= len(data[ch]):
-                    # Don't create value-errors
-                    continue
-                data[ch, ix] += noise_data[id_t+ix]
+        for i in pulse_order:
+            ch = pulse_channel[i]
+            channel_mask['mask'][ch] = True
+            channel_mask['left'][ch] = min(pulse_left[i], channel_mask['left'][ch])
+            channel_mask['right'][ch] = max(pulse_right[i], channel_mask['right'][ch])
+
+            he_row = he_row_of_ch[ch]
+            for j in range(pulse_offsets[i], pulse_offsets[i + 1]):
+                ix = pulse_left[i] - left + j - pulse_offsets[i]
+                # current_2_adc is float64, so the product is taken in double as before
+                adc = - np.int64(np.trunc(pulse_current[j] * current_2_adc))
+                raw_data[ch, ix] += adc
+                if he_row >= 0:
+                    raw_data[he_row, ix] += adc * he_factor
 
     @staticmethod
-    @njit
-    def add_baseline(data, channel_mask, baseline):
-        for ch in range(data.shape[0]):
-            if not channel_mask['mask'][ch]:
-                continue
-            left, right = channel_mask['left'][ch], channel_mask['right'][ch]
-            for ix in range(left, right+1):
-                data[ch, ix] += baseline
+    def noise_offsets(channel_mask, noise_data_length):
+        """
+        Random start in the noise data for each masked channel, drawn in one call
+        """
+        mask = channel_mask['mask']
+        id_ts = np.zeros(len(channel_mask), dtype=np.int64)
+        id_ts[mask] = np.random.randint(
+            0, noise_data_length - channel_mask['right'][mask] + channel_mask['left'][mask])
+        return id_ts
 
     @staticmethod
-    @njit
-    def digitizer_saturation(data, channel_mask):
-        for ch in range(data.shape[0]):
+    @njit(parallel=True, cache=True)
+    def finalize_channels(data, channel_mask, noise_data, noise_data_length, baseline, enable_noise, id_ts):
+        """
+        Add noise (if enable_noise) and the baseline, then clip
+        negative values to zero for digitizer saturation, touching each sample only
+        once. The noise of channel ch starts at id_ts[ch] in noise_data, see noise_offsets
+        """
+        for ch in prange(data.shape[0]):
             if not channel_mask['mask'][ch]:
                 continue
             left, right = channel_mask['left'][ch], channel_mask['right'][ch]
-            for ix in range(left, right+1):
-                if data[ch, ix] < 0:
-                    data[ch, ix] = 0
+            id_t = id_ts[ch]
+            for ix in range(left, min(right+1, data.shape[1])):
+                value = data[ch, ix]
+                if enable_noise and id_t+ix < noise_data_length:
+                    value = np.int64(value + noise_data[id_t+ix])
+                value += baseline
+                data[ch, ix] = max(value, 0)
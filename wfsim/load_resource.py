@@ -119,6 +119,12 @@ class Resource:
 
         # Photon After Pulses
         self.uniform_to_pmt_ap = straxen.get_resource(files['photon_ap_cdfs'], fmt='pkl.gz')
+        # The cdfs are lookup tables only, float32 is plenty. Uniform elements hold delay bounds in ns
+        self.uniform_to_pmt_ap = {
+            element: {k: (np.asarray(v, dtype=np.float32)
+                          if k.endswith('_cdf') and 'Uniform' not in element else v)
+                      for k, v in tables.items()}
+            for element, tables in self.uniform_to_pmt_ap.items()}
 
         # Noise sample
         self.noise_data = straxen.get_resource(files['noise_file'], fmt='npy')['arr_0'].flatten()
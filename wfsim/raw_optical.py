@@ -19,6 +19,7 @@ class RawDataOptical(wfsim.RawData):
             pe_el=wfsim.PhotoElectric_Electron(config),
             pmt_ap=wfsim.PMT_Afterpulse(config))
         self.resource = load_config(self.config)
+        self.init_digitizer_constants()
 
     def __call__(self, instructions, channels, timings, truth_buffer=None, **kwargs):
         if truth_buffer is None:
@@ -40,28 +41,39 @@ class RawDataOptical(wfsim.RawData):
         # thus type%2-1 is 0:S1-esque;  -1:S2-esque
         # Make a list of clusters of instructions, with gap smaller then rext
         inst_time = instructions['time']
-        inst_queue = np.argsort(inst_time)
-        inst_queue = np.split(inst_queue, np.where(np.diff(inst_time[inst_queue]) > rext)[0]+1)
+        # Keep the sorted order and the cluster bounds, clusters are taken from them one by one
+        inst_order = np.argsort(inst_time, kind='stable')
+        inst_bounds = np.concatenate(([0],
+                                      np.nonzero(np.diff(inst_time[inst_order]) > rext)[0] + 1,
+                                      [len(inst_order)]))
+        n_clusters, i_cluster = len(inst_bounds) - 1, 0
 
         # Instruction buffer
         instb = np.zeros(100000, dtype=instructions.dtype)  # size ~ 1% of size of primary
         instb_filled = np.zeros_like(instb, dtype=bool)  # Mask of where buffer is filled
+        # Stack of free buffer slots, the lowest slots are on top to start with
+        free_stack = np.arange(len(instb))[::-1].copy()
+        free_top = len(instb)
 
         # ik those are illegible, messy logic. lmk if you have a better way
-        pbar = tqdm(total=len(inst_queue), desc='Simulating Raw Records')
+        pbar = tqdm(total=n_clusters, desc='Simulating Raw Records')
         while not self.source_finished:
 
             # A) Add a new instruction into buffer
-            try:
-                ixs = inst_queue.pop(0)  # The index from original instruction list
-                self.source_finished = len(inst_queue) == 0
-                assert len(np.where(~instb_filled)[0]) > len(ixs), "Run out of instruction buffer"
-                ib = np.where(~instb_filled)[0][:len(ixs)]  # The index of first empty slot in buffer
-                instb[ib] = instructions[ixs]
-                instb_filled[ib] = True
-                pbar.update(1)
-            except:
-                pass
+            if i_cluster < n_clusters:
+                try:
+                    # The index from original instruction list
+                    ixs = inst_order[inst_bounds[i_cluster]:inst_bounds[i_cluster + 1]]
+                    i_cluster += 1
+                    self.source_finished = i_cluster == n_clusters
+                    assert free_top > len(ixs), "Run out of instruction buffer"
+                    ib = free_stack[free_top - len(ixs):free_top] # Pop free slots from the stack
+                    free_top -= len(ixs)
+                    instb[ib] = instructions[ixs]
+                    instb_filled[ib] = True
+                    pbar.update(1)
+                except:
+                    pass
 
             # B) Cluster instructions again with gap size <= rext
             instb_indx = np.where(instb_filled)[0]
@@ -94,7 +106,9 @@ class RawDataOptical(wfsim.RawData):
                         for instb_secondary in self.sim_data(instruction=instb[instb_run],
                                                              channels=channels[instb[instb_run]['event_number'][0]],
                                                              timings=instb[instb_run]['time'] + timings[instb[instb_run]['event_number'][0]]):
-                            ib = np.where(~instb_filled)[0][:len(instb_secondary)]
+                            assert free_top >= len(instb_secondary), "Run out of instruction buffer"
+                            ib = free_stack[free_top - len(instb_secondary):free_top]
+                            free_top -= len(instb_secondary)
                             instb[ib] = instb_secondary
                             instb_filled[ib] = True
 
@@ -102,13 +116,15 @@ class RawDataOptical(wfsim.RawData):
                             self.get_truth(instb[instb_run], truth_buffer)
 
                         instb_filled[instb_run] = False # Free buffer AFTER copyting into truth buffer
+                        free_stack[free_top:free_top + len(instb_run)] = instb_run
+                        free_top += len(instb_run)
 
                 if stop_at_this_group: 
                     break
                 self.digitize_pulse_cache() # from pulse cache to raw data
                 yield from self.ZLE()
                 
-            self.source_finished = len(inst_queue) == 0 and np.sum(instb_filled) == 0
+            self.source_finished = i_cluster == n_clusters and free_top == len(instb)
         pbar.close()
 
     @staticmethod
@@ -31,7 +31,8 @@ def init_spe_scaling_factor_distributions(file):
 
 
 @export
-@numba.jit(numba.int32(numba.int64[:], numba.int64, numba.int64, numba.int64[:, :]),
+@numba.jit([numba.int32(numba.int64[:], numba.int64, numba.int64, numba.int64[:, :]),
+            numba.int32(numba.int32[:], numba.int64, numba.int64, numba.int64[:, :])],
            nopython=True)
 def find_intervals_below_threshold(w, threshold, holdoff, result_buffer):
     """Fills result_buffer with l, r bounds of intervals in w < threshold.
@@ -75,3 +76,75 @@ def find_intervals_below_threshold(w, threshold, holdoff, result_buffer):
 
     n_intervals = current_interval  # No +1, as current_interval was incremented also when the last interval closed
     return n_intervals
+
+
+@export
+@numba.njit(parallel=True, cache=True)
+def zle_intervals(data, channel_mask, thresholds, holdoff, trigger_window):
+    """Zero length encoding intervals of all channels of data at once.
+    :param data: 2d array of waveforms, one row per channel
+    :param channel_mask: channel mask with 'mask', 'left', 'right' fields, only the
+                         [left, right] range of the masked channels is searched
+    :param thresholds: per channel threshold, see find_intervals_below_threshold
+    :param holdoff: see find_intervals_below_threshold
+    :param trigger_window: samples to extend the intervals with on both sides
+    :returns : array of (channel, left, right) rows, left and right are inclusive,
+               relative to channel_mask['left'] of the channel and even
+    """
+    n_channels = data.shape[0]
+    dummy = np.zeros((0, 3), dtype=np.int64)
+
+    # First count the intervals of each channel, then fill them in at the channel offsets
+    counts = np.zeros(n_channels, dtype=np.int64)
+    for ch in numba.prange(n_channels):
+        if channel_mask['mask'][ch]:
+            w = data[ch, channel_mask['left'][ch]:channel_mask['right'][ch] + 1]
+            counts[ch] = _zle_channel(w, thresholds[ch], holdoff, trigger_window, ch, dummy, 0, False)
+
+    offsets = np.zeros(n_channels + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    result = np.zeros((offsets[-1], 3), dtype=np.int64)
+    for ch in numba.prange(n_channels):
+        if channel_mask['mask'][ch]:
+            w = data[ch, channel_mask['left'][ch]:channel_mask['right'][ch] + 1]
+            _zle_channel(w, thresholds[ch], holdoff, trigger_window, ch, result, offsets[ch], True)
+    return result
+
+
+@numba.njit
+def _zle_channel(w, threshold, holdoff, trigger_window, channel, result, offset, fill):
+    """Same interval search as find_intervals_below_threshold, writing (channel, left, right)
+    rows from result[offset] on if fill, with intervals extended by trigger_window, clipped
+    to w and landed on even numbers. Returns the number of intervals
+    """
+    last_index_in_w = len(w) - 1
+
+    in_interval = False
+    n_intervals = 0
+    current_interval_start = -1
+    current_interval_end = -1
+
+    for i in range(len(w)):
+        x = w[i]
+        if x < threshold:
+            if not in_interval:
+                # Start of an interval
+                in_interval = True
+                current_interval_start = i
+
+            current_interval_end = i
+
+        if ((i == last_index_in_w and in_interval) or
+                (x >= threshold and i >= current_interval_end + holdoff and in_interval)):
+            # End of the current interval
+            in_interval = False
+
+            if fill:
+                left = min(max(current_interval_start - trigger_window, 0), last_index_in_w)
+                right = min(max(current_interval_end + trigger_window, 0), last_index_in_w)
+                result[offset + n_intervals, 0] = channel
+                result[offset + n_intervals, 1] = (left + 1) & ~1  # ceil to even
+                result[offset + n_intervals, 2] = right & ~1  # floor to even
+            n_intervals += 1
+
+    return n_intervals